@@ -3,7 +3,7 @@
 Flujo: Por cada carpeta fuente en Google Drive:
   1) Listar los PDFs (solo nivel de la carpeta, no subcarpetas).
   2) Descargar y unirlos en 1 PDF (orden por fecha de creación ascendente).
-  3) (Opcional) Comprimir el PDF resultante con Ghostscript.
+  3) (Opcional) Comprimir el PDF resultante (qpdf sin pérdida o Ghostscript).
   4) Subir el "compilado" a una subcarpeta llamada "Compilados" dentro de ESA MISMA carpeta.
   5) Enviar los PDFs originales a la PAPELERA (no borrado definitivo).
   6) Evita duplicados del mismo día: si ya existe "Compilado de AAAA-MM-DD.pdf" lo manda a papelera y sube el nuevo.
@@ -12,21 +12,31 @@ Notas:
 - No mezcla nada entre carpetas: cada carpeta genera su propio compilado.
 - Si la subcarpeta "Compilados" no existe, se crea automáticamente.
 - Maneja PDFs dañados/protegidos: se saltan y sigue con el resto.
+- PDFs repetidos (mismo contenido) se incluyen una sola vez en el compilado.
 - Autenticación por defecto con OAuth (tu cuenta); Service Account solo si trabajas en Unidad compartida.
 """
 
-import os, io, json, datetime, tempfile, logging, subprocess, shutil
-from typing import List, Optional
+import os, io, json, datetime, tempfile, logging, math, subprocess, shutil, threading, time, random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple, Union
 
-from pypdf import PdfReader, PdfWriter
+import pikepdf
 
 # Google Drive API
 from google.oauth2 import service_account  # usado solo si AUTH_MODE=service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from googleapiclient.model import JsonModel
+
+try:
+    import orjson  # opcional: parseo JSON más rápido de las respuestas de Drive
+except ImportError:
+    orjson = None
 
 # --------- Configuración general (vienen del workflow) ---------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(threadName)s]: %(message)s")
 
 SCOPES = ["https://www.googleapis.com/auth/drive"]  # lectura/escritura/papelera
 AUTH_MODE = os.getenv("AUTH_MODE", "oauth").lower()  # "oauth" (recomendado) | "service_account"
@@ -48,177 +58,689 @@ COMPILED_SUBFOLDER_NAME = os.getenv("COMPILED_SUBFOLDER_NAME", "Compilados").str
 # Compresión (controlado por env en el workflow)
 PDF_COMPRESS = os.getenv("PDF_COMPRESS", "false").lower() == "true"
 PDF_QUALITY = os.getenv("PDF_QUALITY", "ebook")  # screen | ebook | printer | prepress | default
+# qpdf: sin pérdida (rápido) | gs: Ghostscript | auto: qpdf, y GS solo si hay imágenes que reducir
+PDF_COMPRESS_MODE = os.getenv("PDF_COMPRESS_MODE", "auto").lower()
+# PDFs grandes: se parten en tramos de al menos GS_PAGES_PER_PART páginas y se comprimen
+# en paralelo (un proceso gs por tramo). GS_WORKERS es el tope de procesos gs simultáneos
+# en TODO el proceso (sumando las carpetas que comprimen a la vez)
+GS_PAGES_PER_PART = max(1, int(os.getenv("GS_PAGES_PER_PART", "100")))
+GS_WORKERS = max(1, int(os.getenv("GS_WORKERS", str(os.cpu_count() or 1))))
+
+# Binario de Ghostscript: se busca UNA vez al arrancar (solo si se va a comprimir con GS).
+# En modo "gs" falla de inmediato si no está; en "auto" se sigue solo con qpdf.
+_GS_BIN = shutil.which("gs") if PDF_COMPRESS and PDF_COMPRESS_MODE != "qpdf" else None
+if PDF_COMPRESS and PDF_COMPRESS_MODE == "gs" and not _GS_BIN:
+    raise RuntimeError("PDF_COMPRESS_MODE=gs pero no se encontró Ghostscript ('gs') en el PATH. "
+                       "¿Instalaste ghostscript en el workflow?")
+if _GS_BIN:
+    try:
+        _gs_version = subprocess.run([_GS_BIN, "--version"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        _gs_version = ""
+    logging.info(f"Ghostscript: {_GS_BIN} (versión {_gs_version or '?'})")
+elif PDF_COMPRESS and PDF_COMPRESS_MODE == "auto":
+    logging.warning("Ghostscript no encontrado: se comprimirá solo con qpdf (sin pérdida).")
+
+# Paralelismo: carpetas a la vez, y descargas a la vez dentro de cada carpeta
+FOLDER_CONCURRENCY = max(1, int(os.getenv("FOLDER_CONCURRENCY", "4")))
+DOWNLOAD_CONCURRENCY = max(1, int(os.getenv("DOWNLOAD_CONCURRENCY", "8")))
+
+# Tamaño de bloque de descarga en MiB (1 GET por bloque). 100 = default de googleapiclient,
+# así casi cualquier PDF baja en una sola petición; no conviene bajarlo.
+DL_CHUNK_SIZE = max(1, int(os.getenv("DL_CHUNK", "100"))) * 1024 * 1024
+
+# Reintentos ante errores transitorios de Drive (429/5xx) y tope global de
+# peticiones simultáneas (sumando todos los hilos), para no provocar tormentas de 429
+DRIVE_MAX_RETRIES = max(0, int(os.getenv("DRIVE_MAX_RETRIES", "6")))
+DRIVE_INFLIGHT = max(1, int(os.getenv("DRIVE_INFLIGHT", "12")))
+
+# Subidas menores a esto van en una sola petición; las mayores, por sesión resumable
+UPLOAD_SINGLE_SHOT_MAX = 20 * 1024 * 1024
+
+# El compilado se arma en memoria y solo pasa a disco si supera este tamaño (MiB)
+MERGE_SPOOL_MAX_SIZE = max(1, int(os.getenv("MERGE_SPOOL_MB", "128"))) * 1024 * 1024
+
+# Caché local {carpeta_fuente: id_subcarpeta_compilados} entre corridas (en CI: actions/cache)
+COMPILED_CACHE_PATH = os.path.expanduser(
+    os.getenv("COMPILED_CACHE_PATH", "~/.cache/drive-pdf-merge/compiled.json"))
+
+# Llamadas por batch al mandar a papelera (Drive acepta hasta 100 por batch)
+TRASH_BATCH_SIZE = 100
 
 
 # --------- Cliente de Drive ---------
-def drive_client():
+_creds = None
+_creds_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+
+
+def _serialize_refresh(creds):
+    """
+    Envuelve creds.refresh con un lock. El transporte HTTP de cada cliente renueva por su
+    cuenta (token vencido o 401 a mitad de la corrida), así que sin esto varios hilos harían
+    el canje a la vez sobre el mismo objeto. Si otro hilo ya trajo un token nuevo mientras
+    se esperaba el lock, se reutiliza en vez de canjear de nuevo.
     """
-    Crea cliente Drive según AUTH_MODE:
+    refresh = creds.refresh
+
+    def _locked_refresh(request):
+        stale = creds.token
+        with _refresh_lock:
+            if creds.token != stale and creds.valid:
+                return
+            refresh(request)
+
+    creds.refresh = _locked_refresh
+    return creds
+
+
+def _credentials():
+    """
+    Credenciales compartidas por todos los clientes Drive (se crean una sola vez) según AUTH_MODE:
       - "oauth": usa TU cuenta y almacenamiento (recomendado para Mi unidad).
       - "service_account": útil si trabajas en Unidad compartida (Shared Drive).
+    Así, con varios hilos, el refresh_token se canjea UNA vez y no una por cliente.
+    """
+    global _creds
+    with _creds_lock:
+        if _creds is not None:
+            return _creds
+
+        if AUTH_MODE == "oauth":
+            from google.oauth2.credentials import Credentials
+
+            client_id = _req_env("GOOGLE_CLIENT_ID")
+            client_secret = _req_env("GOOGLE_CLIENT_SECRET")
+            refresh_token = _req_env("GOOGLE_REFRESH_TOKEN")
+
+            logging.info(f"OAuth client_id: ****{client_id[-4:]} (len={len(client_id)})")
+            logging.info(f"Have refresh_token: {'yes' if len(refresh_token)>10 else 'no'}")
+
+            _creds = Credentials(
+                token=None,
+                refresh_token=refresh_token,
+                token_uri="https://oauth2.googleapis.com/token",
+                client_id=client_id,
+                client_secret=client_secret,
+                scopes=SCOPES,
+            )
+        else:
+            # Service Account (solo si usas Unidad compartida)
+            info = json.loads(_req_env("GOOGLE_CREDENTIALS"))
+            _creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
+        return _serialize_refresh(_creds)
+
+
+class _OrjsonModel(JsonModel):
+    """
+    JsonModel de googleapiclient que parsea las respuestas con orjson: los listados de
+    1000 archivos por página se decodifican varias veces más rápido y con menos basura.
     """
-    if AUTH_MODE == "oauth":
-        from google.oauth2.credentials import Credentials
-        from google.auth.transport.requests import Request
 
-        client_id = _req_env("GOOGLE_CLIENT_ID")
-        client_secret = _req_env("GOOGLE_CLIENT_SECRET")
-        refresh_token = _req_env("GOOGLE_REFRESH_TOKEN")
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and isinstance(body, dict) and "data" in body:
+            body = body["data"]
+        return body
 
-        logging.info(f"OAuth client_id: ****{client_id[-4:]} (len={len(client_id)})")
-        logging.info(f"Have refresh_token: {'yes' if len(refresh_token)>10 else 'no'}")
 
-        creds = Credentials(
-            token=None,
-            refresh_token=refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=client_id,
-            client_secret=client_secret,
-            scopes=SCOPES,
-        )
+def drive_client():
+    """
+    Crea un cliente Drive (con su propio objeto HTTP) sobre las credenciales compartidas.
+    Si el access_token no existe o venció, se renueva (refresh serializado, ver
+    _serialize_refresh): un solo hilo hace el canje y los demás reutilizan el token nuevo.
+    """
+    from google.auth.transport.requests import Request
+
+    creds = _credentials()
+    if not creds.valid:
         # Intercambia refresh_token por access_token válido
         creds.refresh(Request())
-        return build("drive", "v3", credentials=creds, cache_discovery=False)
+    model = _OrjsonModel() if orjson is not None else None  # None = JsonModel estándar
+    return build("drive", "v3", credentials=creds, cache_discovery=False, model=model)
+
+
+_thread_local = threading.local()
+
+
+def thread_drive_client():
+    """
+    Devuelve un cliente Drive propio del hilo actual (se crea la primera vez).
+    Los objetos HTTP de googleapiclient NO son thread-safe: cada hilo usa el suyo.
+    """
+    drive = getattr(_thread_local, "drive", None)
+    if drive is None:
+        drive = drive_client()
+        _thread_local.drive = drive
+    return drive
+
+
+# --------- Reintentos y límite de concurrencia ---------
+_drive_inflight = threading.BoundedSemaphore(DRIVE_INFLIGHT)
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def _retry_delay(exc: Exception, attempt: int, idempotent: bool = True) -> Optional[float]:
+    """
+    Segundos a esperar antes de reintentar, o None si el error no es transitorio.
+    Respeta 'Retry-After' si Drive lo manda; si no, backoff exponencial con jitter.
+    Con idempotent=False solo se reintentan los rechazos por cuota (429 / 403
+    rateLimitExceeded): tras un 5xx, corte o timeout la llamada pudo haberse aplicado.
+    """
+    if isinstance(exc, HttpError):
+        status = int(exc.resp.status)
+        rate_limited = status == 429 or (
+            status == 403 and "ratelimitexceeded" in str(exc.error_details).lower())
+        if not rate_limited and (not idempotent or status not in _RETRY_STATUS):
+            return None
+        retry_after = str(exc.resp.get("retry-after", "")).strip()
+        if retry_after.isdigit():
+            return float(retry_after)
+    elif not idempotent or not isinstance(exc, (ConnectionError, TimeoutError)):
+        return None
+    return min(64, 2 ** attempt) + random.random()
+
+
+def drive_call(fn, idempotent: bool = True):
+    """
+    Ejecuta fn() (una llamada a Drive) ocupando un cupo del semáforo global y
+    reintentando los errores transitorios hasta DRIVE_MAX_RETRIES veces.
+    La espera entre intentos se hace SIN ocupar cupo.
+    Las llamadas que crean archivos van con idempotent=False (ver _retry_delay),
+    para no terminar con subcarpetas o compilados duplicados.
+    """
+    attempt = 0
+    while True:
+        try:
+            with _drive_inflight:
+                return fn()
+        except Exception as e:
+            delay = _retry_delay(e, attempt, idempotent)
+            if delay is None or attempt >= DRIVE_MAX_RETRIES:
+                raise
+            attempt += 1
+            logging.warning(f"Error transitorio de Drive ({e}); reintento {attempt}/{DRIVE_MAX_RETRIES} en {delay:.1f}s")
+            time.sleep(delay)
+
 
-    # Service Account (solo si usas Unidad compartida)
-    info = json.loads(_req_env("GOOGLE_CREDENTIALS"))
-    creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
-    return build("drive", "v3", credentials=creds, cache_discovery=False)
+def drive_execute(request, idempotent: bool = True):
+    """request.execute() con reintentos y semáforo global (ver drive_call)."""
+    return drive_call(request.execute, idempotent)
 
 
 # --------- Utilidades de Drive ---------
-def get_folder_name(drive, folder_id: str) -> str:
-    """Devuelve el nombre de una carpeta por su ID."""
-    return drive.files().get(fileId=folder_id, fields="name", supportsAllDrives=True).execute()["name"]
+_FOLDER_MIME = "application/vnd.google-apps.folder"
 
 
-def list_pdfs_in_folder(drive, folder_id: str) -> list:
+def list_folder_contents(drive, folder_id: str, compiled_hint: Optional[str] = None,
+                         date_str: Optional[str] = None) -> Tuple[str, list, Optional[str], Optional[list]]:
     """
-    Lista PDFs directamente dentro de la carpeta (NO incluye subcarpetas).
-    Si existe un subfolder “Compilados”, sus archivos NO aparecen aquí.
+    Lee de una sola vez lo que hace falta de la carpeta fuente:
+      - su nombre,
+      - los PDFs directamente dentro (NO incluye subcarpetas), por fecha de creación,
+      - el ID de la subcarpeta de compilados si ya existe (si no, None).
+    PDFs y subcarpeta salen de UNA misma consulta, y va en un batch junto con el
+    nombre: una sola ida y vuelta a Drive (más páginas solo si hay >1000 archivos).
+
+    Si se pasa 'compiled_hint' (ID de la caché) y 'date_str', en el mismo batch se
+    buscan también los compilados de ese día ya subidos; solo se usan si el listado
+    confirma que ese ID sigue siendo la subcarpeta (si no, se devuelve None).
+    Devuelve (nombre, pdfs, id_compilados, compilados_del_dia | None).
     """
     query = (
-        f"'{folder_id}' in parents and "
-        f"mimeType='application/pdf' and trashed=false"
+        f"'{folder_id}' in parents and trashed=false and "
+        f"(mimeType='application/pdf' or "
+        f"(mimeType='{_FOLDER_MIME}' and name='{COMPILED_SUBFOLDER_NAME}'))"
     )
-    files = []
-    page_token = None
-    while True:
-        resp = drive.files().list(
+
+    def _list_request(page_token=None):
+        return drive.files().list(
             q=query,
-            fields="nextPageToken, files(id, name, createdTime, size)",
+            fields="nextPageToken, files(id, name, mimeType, md5Checksum)",
+            orderBy="createdTime",  # Drive ya los devuelve por fecha de creación ascendente
             pageSize=1000,
             pageToken=page_token,
             includeItemsFromAllDrives=True,
             supportsAllDrives=True,
-        ).execute()
-        files.extend(resp.get("files", []))
+        )
+
+    def _first_round():
+        responses, errors = {}, []
+
+        def _callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            elif request_id != "compiled_today":  # la búsqueda anticipada es opcional
+                errors.append(exception)
+
+        batch = drive.new_batch_http_request(callback=_callback)
+        batch.add(drive.files().get(fileId=folder_id, fields="name", supportsAllDrives=True), request_id="folder")
+        batch.add(_list_request(), request_id="children")
+        if compiled_hint and date_str:
+            batch.add(_compiled_for_day_request(drive, compiled_hint, date_str), request_id="compiled_today")
+        batch.execute()
+        if errors:
+            raise errors[0]  # drive_call decide si se reintenta
+        return responses
+
+    first = drive_call(_first_round)
+    folder_name = first["folder"]["name"]
+    children = list(first["children"].get("files", []))
+    page_token = first["children"].get("nextPageToken")
+    while page_token:
+        resp = drive_execute(_list_request(page_token))
+        children.extend(resp.get("files", []))
         page_token = resp.get("nextPageToken")
-        if not page_token:
-            break
-    return files
+
+    pdfs = [f for f in children if f.get("mimeType") != _FOLDER_MIME]
+    subfolders = [f["id"] for f in children if f.get("mimeType") == _FOLDER_MIME]
+    compiled_id = subfolders[0] if subfolders else None
+    compiled_today = None
+    if compiled_id and compiled_id == compiled_hint and "compiled_today" in first:
+        compiled_today = first["compiled_today"].get("files", [])
+    return folder_name, pdfs, compiled_id, compiled_today
+
+
+# --------- Caché de subcarpetas 'Compilados' entre corridas ---------
+_compiled_cache = {}
+_compiled_cache_lock = threading.Lock()
+
+
+def load_compiled_cache():
+    """Carga de disco el mapa {carpeta_fuente: id_compilados} (si no existe, queda vacío)."""
+    try:
+        with open(COMPILED_CACHE_PATH, encoding="utf-8") as fh:
+            data = json.load(fh)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logging.warning(f"Caché de compilados ilegible, se ignora: {COMPILED_CACHE_PATH} ({e})")
+        return
+    if isinstance(data, dict):
+        with _compiled_cache_lock:
+            _compiled_cache.update({str(k): str(v) for k, v in data.items()})
+
+
+def save_compiled_cache():
+    """Guarda el mapa en disco (escritura atómica: archivo temporal + rename)."""
+    with _compiled_cache_lock:
+        data = dict(_compiled_cache)
+    try:
+        os.makedirs(os.path.dirname(COMPILED_CACHE_PATH), exist_ok=True)
+        tmp_path = COMPILED_CACHE_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, COMPILED_CACHE_PATH)
+    except OSError as e:
+        logging.warning(f"No se pudo guardar la caché de compilados: {e}")
+
+
+def cached_compiled_folder(folder_id: str) -> Optional[str]:
+    """ID de la subcarpeta de compilados recordado de una corrida anterior (o None)."""
+    with _compiled_cache_lock:
+        return _compiled_cache.get(folder_id)
+
+
+def remember_compiled_folder(folder_id: str, compiled_id: Optional[str]):
+    """Actualiza la caché; None (o el ID ficticio de DRY_RUN) borra la entrada."""
+    with _compiled_cache_lock:
+        if compiled_id and not compiled_id.startswith("dry_run"):
+            _compiled_cache[folder_id] = compiled_id
+        else:
+            _compiled_cache.pop(folder_id, None)
+
+
+def dedupe_by_checksum(pdfs: list) -> Tuple[list, dict]:
+    """
+    Quita PDFs repetidos (mismo contenido, según el md5Checksum que da Drive) ANTES
+    de descargarlos: se queda con el primero de cada grupo (el más antiguo).
+    Devuelve (únicos, {id_que_se_queda: [duplicados]}).
+    Archivos sin md5Checksum se tratan siempre como únicos.
+    """
+    unique, duplicates, first_by_md5 = [], {}, {}
+    for f in pdfs:
+        md5 = f.get("md5Checksum")
+        if md5 and md5 in first_by_md5:
+            duplicates.setdefault(first_by_md5[md5], []).append(f)
+            continue
+        if md5:
+            first_by_md5[md5] = f["id"]
+        unique.append(f)
+    return unique, duplicates
 
 
-def ensure_compiled_subfolder(drive, parent_folder_id: str) -> str:
+def ensure_compiled_subfolder(drive, parent_folder_id: str, known_id: Optional[str] = None,
+                              listed: bool = False) -> str:
     """
     Busca (y si no existe, crea) la subcarpeta de compilados dentro de la carpeta fuente.
+    Si ya se conoce su ID (p. ej. de list_folder_contents) lo devuelve sin consultar Drive.
+    Con listed=True el llamador ya listó la carpeta completa sin encontrarla: se crea
+    directo, sin repetir la búsqueda.
     Devuelve el ID de la subcarpeta.
     """
-    # 1) Buscar subcarpeta existente
-    q = (
-        f"'{parent_folder_id}' in parents and "
-        f"mimeType='application/vnd.google-apps.folder' and "
-        f"name='{COMPILED_SUBFOLDER_NAME}' and trashed=false"
-    )
-    resp = drive.files().list(
-        q=q, fields="files(id,name)", pageSize=1,
-        includeItemsFromAllDrives=True, supportsAllDrives=True
-    ).execute()
-    items = resp.get("files", [])
-    if items:
-        return items[0]["id"]
+    if known_id:
+        return known_id
+    if not listed:
+        # 1) Buscar subcarpeta existente
+        q = (
+            f"'{parent_folder_id}' in parents and "
+            f"mimeType='{_FOLDER_MIME}' and "
+            f"name='{COMPILED_SUBFOLDER_NAME}' and trashed=false"
+        )
+        resp = drive_execute(drive.files().list(
+            q=q, fields="files(id,name)", pageSize=1,
+            includeItemsFromAllDrives=True, supportsAllDrives=True
+        ))
+        items = resp.get("files", [])
+        if items:
+            return items[0]["id"]
 
     # 2) Crear subcarpeta si no existe
     metadata = {
         "name": COMPILED_SUBFOLDER_NAME,
-        "mimeType": "application/vnd.google-apps.folder",
+        "mimeType": _FOLDER_MIME,
         "parents": [parent_folder_id],
     }
     if DRY_RUN:
         logging.info(f"[DRY_RUN] Crearía subcarpeta '{COMPILED_SUBFOLDER_NAME}' en {parent_folder_id}")
         return "dry_run_subfolder"
-    created = drive.files().create(
+    created = drive_execute(drive.files().create(
         body=metadata, fields="id", supportsAllDrives=True
-    ).execute()
+    ), idempotent=False)
     logging.info(f"Subcarpeta de compilados creada: {created['id']}")
     return created["id"]
 
 
-def download_file(drive, file_id: str, dest_path: str) -> str:
-    """Descarga un archivo de Drive a dest_path."""
+def download_file(drive, file_id: str) -> io.BytesIO:
+    """Descarga un archivo de Drive a memoria y devuelve el buffer (posicionado al inicio)."""
     request = drive.files().get_media(fileId=file_id)
-    with io.FileIO(dest_path, "wb") as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-    return dest_path
+    buf = io.BytesIO()
+    downloader = MediaIoBaseDownload(buf, request, chunksize=DL_CHUNK_SIZE)
+    done = False
+    while not done:
+        status, done = drive_call(downloader.next_chunk)
+    buf.seek(0)
+    return buf
 
 
-def upload_pdf(drive, folder_id: str, file_path: str, name: str) -> dict:
-    """Sube un PDF a la carpeta indicada y devuelve {id, webViewLink}."""
-    media = MediaFileUpload(file_path, mimetype="application/pdf", resumable=True)
+def iter_downloads(files: list) -> Iterator[tuple]:
+    """
+    Descarga en paralelo los archivos a memoria (DOWNLOAD_CONCURRENCY hilos) y va
+    entregando (archivo, buffer) en el MISMO orden de 'files' apenas cada uno está
+    listo: el merge arranca con el primero mientras los demás siguen bajando.
+    Si una descarga falla (ya agotados los reintentos de drive_call) se corta toda la
+    carpeta: un compilado parcial, al re-correr el mismo día, reemplazaría al completo.
+    """
+    def _download(f: dict) -> io.BytesIO:
+        buf = download_file(thread_drive_client(), f["id"])
+        buf.name = f["name"]  # para que los avisos del merge digan qué PDF es
+        return buf
+
+    pool = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="descarga")
+    try:
+        futures = [pool.submit(_download, f) for f in files]
+        for f, fut in zip(files, futures):
+            try:
+                buf = fut.result()
+            except Exception as e:
+                raise RuntimeError(f"No se pudo descargar {f['name']}: {e}") from e
+            yield f, buf
+    finally:
+        # Si el consumidor falla a mitad, no seguimos bajando lo que falta
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def upload_pdf(drive, folder_id: str, fh: BinaryIO, name: str) -> dict:
+    """
+    Sube un PDF (archivo abierto o en memoria) a la carpeta indicada y devuelve {id, webViewLink}.
+    Hasta UPLOAD_SINGLE_SHOT_MAX se sube en una sola petición (multipart): la sesión
+    resumable agrega una ida y vuelta extra que solo compensa en archivos grandes.
+    """
+    resumable = _stream_size(fh) >= UPLOAD_SINGLE_SHOT_MAX
+    media = MediaIoBaseUpload(fh, mimetype="application/pdf", resumable=resumable)
     file_metadata = {"name": name, "parents": [folder_id]}
     if DRY_RUN:
         logging.info(f"[DRY_RUN] Subiría '{name}' a carpeta {folder_id}")
         return {"id": "dry_run", "webViewLink": "dry_run"}
-    created = drive.files().create(
+    created = drive_execute(drive.files().create(
         body=file_metadata, media_body=media, fields="id,webViewLink", supportsAllDrives=True
-    ).execute()
+    ), idempotent=False)
     return created
 
 
-def move_to_trash(drive, file_id: str):
-    """Mueve un archivo a la papelera (NO borra definitivo)."""
+def move_to_trash(drive, file_ids: List[str]) -> List[str]:
+    """
+    Mueve archivos a la papelera (NO borra definitivo) en lotes: una sola petición
+    HTTP por cada TRASH_BATCH_SIZE archivos. Devuelve los IDs que sí se enviaron.
+    Los ítems rechazados por límite de tasa se reintentan; otros errores se avisan
+    y se sigue con el resto.
+    """
     if DRY_RUN:
-        logging.info(f"[DRY_RUN] PAPELERA -> {file_id}")
-        return
-    drive.files().update(fileId=file_id, body={"trashed": True}, supportsAllDrives=True).execute()
+        for fid in file_ids:
+            logging.info(f"[DRY_RUN] PAPELERA -> {fid}")
+        return list(file_ids)
+
+    trashed = []
+    pending = list(file_ids)
+    for attempt in range(DRIVE_MAX_RETRIES + 1):
+        retry = []
+
+        def _callback(request_id, response, exception):
+            if exception is None:
+                trashed.append(request_id)
+            elif attempt < DRIVE_MAX_RETRIES and _retry_delay(exception, attempt) is not None:
+                retry.append(request_id)
+            else:
+                logging.warning(f"No se pudo enviar a papelera {request_id}: {exception}")
+
+        for start in range(0, len(pending), TRASH_BATCH_SIZE):
+            batch = drive.new_batch_http_request(callback=_callback)
+            for fid in pending[start:start + TRASH_BATCH_SIZE]:
+                batch.add(
+                    drive.files().update(fileId=fid, body={"trashed": True}, supportsAllDrives=True),
+                    request_id=fid,
+                )
+            drive_execute(batch)
+
+        if not retry:
+            break
+        pending = retry
+        time.sleep(min(64, 2 ** attempt) + random.random())
+    return trashed
 
 
 # --------- Merge local de PDFs ---------
-def merge_local_pdfs(paths: List[str], output_path: str) -> str:
+def merge_local_pdfs(sources: Iterable[Union[str, BinaryIO]], output: Union[str, BinaryIO]) -> Union[str, BinaryIO]:
     """
-    Une una lista de rutas PDF en 'output_path'.
+    Une los PDFs (rutas o buffers en memoria, en el orden en que llegan) en
+    'output' (ruta o archivo abierto para escritura), con pikepdf/qpdf.
     - Salta PDFs dañados o protegidos, pero continúa con el resto.
     - Lanza error si al final no hay páginas válidas.
+
+    qpdf copia las páginas como referencias y lee los streams crudos de cada fuente
+    recién al guardar, sin volver a codificarlos: por eso las fuentes siguen abiertas
+    hasta save().
     """
-    writer = PdfWriter()
-    for p in paths:
-        try:
-            reader = PdfReader(p)
-            for page in reader.pages:
-                writer.add_page(page)
-        except Exception as e:
-            logging.warning(f"Saltando PDF corrupto/protegido: {p} ({e})")
+    opened = []
+    try:
+        with pikepdf.Pdf.new() as out:
+            for source in sources:
+                n_before = len(out.pages)
+                try:
+                    src = pikepdf.Pdf.open(source)
+                    opened.append(src)
+                    out.pages.extend(src.pages)
+                except Exception as e:
+                    # Deshace páginas a medio copiar de este PDF
+                    del out.pages[n_before:]
+                    logging.warning(f"Saltando PDF corrupto/protegido: {getattr(source, 'name', source)} ({e})")
+
+            if len(out.pages) == 0:
+                raise RuntimeError("No se pudieron leer páginas válidas para el merge.")
+
+            out.save(
+                output,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                compress_streams=True,
+            )
+    finally:
+        for src in opened:
+            src.close()
+
+    return output
+
+
+# --------- Compresión (opcional): qpdf sin pérdida o Ghostscript ---------
+def compress_pdf_qpdf(source: Union[str, BinaryIO], output: BinaryIO) -> bool:
+    """
+    Compresión SIN pérdida con qpdf (vía pikepdf): object streams, streams comprimidos,
+    Flate recomprimido. No toca la resolución de las imágenes, pero tarda una fracción
+    de lo que tarda Ghostscript y no altera el contenido. No se lineariza: las tablas
+    de "hint" agregan bytes y aquí lo que importa es el tamaño.
+    El nivel de Flate queda en el default de qpdf: es un ajuste global del proceso
+    (afectaría a todos los merges de todos los hilos), por eso no se cambia aquí.
+    Devuelve True si escribió algo en 'output'.
+    """
+    try:
+        with pikepdf.open(source) as pdf:
+            pdf.save(
+                output,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                compress_streams=True,
+                recompress_flate=True,
+            )
+        return _stream_size(output) > 0
+    except Exception as e:
+        logging.warning(f"Compresión qpdf falló: {e}")
+        return False
+
+
+def _stream_size(fh: BinaryIO) -> int:
+    """Tamaño en bytes de un archivo abierto (lo deja posicionado al inicio)."""
+    size = fh.seek(0, io.SEEK_END)
+    fh.seek(0)
+    return size
+
+
+def compression_method(source: Union[str, BinaryIO]) -> Optional[str]:
+    """
+    Elige cómo comprimir según PDF_COMPRESS_MODE: "qpdf", "gs" o None (no comprimir).
+      - qpdf: siempre qpdf.
+      - gs:   Ghostscript, salvo que el PDF no tenga nada que reducir.
+      - auto: Ghostscript solo si está instalado, hay imágenes de alta resolución y
+              PDF_QUALITY reduce resolución (screen | ebook); en cualquier otro caso qpdf.
+    """
+    if PDF_COMPRESS_MODE == "qpdf":
+        return "qpdf"
+    if PDF_COMPRESS_MODE == "gs":
+        return "gs" if needs_gs_compression(source) else None
+    if _GS_BIN and PDF_QUALITY.lower() in ("screen", "ebook") and needs_gs_compression(source):
+        return "gs"
+    return "qpdf"
 
-    if len(writer.pages) == 0:
-        raise RuntimeError("No se pudieron leer páginas válidas para el merge.")
 
-    with open(output_path, "wb") as f:
-        writer.write(f)
+def _dpi_limit(bits: int, mask: bool) -> int:
+    """Resolución a la que Ghostscript baja las imágenes: 300 DPI monocromo, 150 el resto."""
+    return 300 if mask or bits == 1 else 150
 
-    return output_path
 
+def _exceeds_dpi(px_w: int, px_h: int, limit: int, ctm: "pikepdf.Matrix") -> bool:
+    """
+    True si una imagen de px_w x px_h dibujada con la matriz 'ctm' pasa de 'limit' DPI.
+    La imagen ocupa el cuadrado unidad transformado por ctm: su tamaño en la página
+    (en puntos) es el largo de los vectores (a, b) y (c, d).
+    """
+    for px, vec in ((px_w, (ctm.a, ctm.b)), (px_h, (ctm.c, ctm.d))):
+        drawn_in = math.hypot(*vec) / 72
+        if px and (drawn_in <= 0 or px / drawn_in > limit):
+            return True
+    return False
 
-# --------- Compresión con Ghostscript (opcional) ---------
-def compress_pdf_gs(input_path: str, output_path: str, quality: str = "ebook") -> bool:
+
+def _draws_high_res_image(content, resources, ctm: "pikepdf.Matrix", depth: int = 0) -> bool:
+    """
+    Recorre el content stream (de una página o de un Form XObject) siguiendo la matriz
+    de transformación (q / Q / cm) y revisa cada imagen al tamaño en que realmente se
+    dibuja (Do e imágenes inline). Los Form XObjects se recorren recursivamente con su
+    /Matrix y sus propios /Resources.
     """
-    Comprime un PDF usando Ghostscript.
+    if depth > 12:  # forms anidados de más (o cíclicos): mejor comprimir
+        return True
+    xobjects = resources.get("/XObject", {}) if resources is not None else {}
+    saved = []
+    for operands, operator in pikepdf.parse_content_stream(content):
+        op = str(operator)
+        if op == "q":
+            saved.append(ctm)
+        elif op == "Q":
+            ctm = saved.pop() if saved else ctm
+        elif op == "cm":
+            ctm = pikepdf.Matrix(*(float(x) for x in operands)) @ ctm
+        elif op == "INLINE IMAGE":
+            img = operands[0]
+            limit = _dpi_limit(img.bits_per_component, img.image_mask)
+            if _exceeds_dpi(img.width, img.height, limit, ctm):
+                return True
+        elif op == "Do":
+            xobj = xobjects.get(str(operands[0]))
+            if xobj is None:
+                continue
+            subtype = xobj.get("/Subtype")
+            if subtype == "/Image":
+                limit = _dpi_limit(int(xobj.get("/BitsPerComponent", 8)), bool(xobj.get("/ImageMask", False)))
+                if _exceeds_dpi(int(xobj.get("/Width", 0)), int(xobj.get("/Height", 0)), limit, ctm):
+                    return True
+            elif subtype == "/Form":
+                matrix = xobj.get("/Matrix")
+                form_ctm = (pikepdf.Matrix(*(float(x) for x in matrix)) if matrix is not None
+                            else pikepdf.Matrix()) @ ctm
+                if _draws_high_res_image(xobj, xobj.get("/Resources", resources), form_ctm, depth + 1):
+                    return True
+    return False
+
+
+def needs_gs_compression(source: Union[str, BinaryIO]) -> bool:
+    """
+    Revisa con pikepdf si vale la pena pasar el PDF por Ghostscript.
+    Ghostscript solo gana de verdad al bajar la resolución de imágenes (el compilado ya
+    sale de merge_local_pdfs con los streams comprimidos): si ninguna imagen se dibuja
+    a más resolución de la que GS dejaría (150 DPI color/gris, 300 DPI monocromo),
+    suele dejar el PDF igual o MÁS grande.
+    La resolución se mide al tamaño en que cada imagen se dibuja (ver _draws_high_res_image),
+    incluidas las que están dentro de Form XObjects.
+    Ante cualquier duda (error al leer) devuelve True y se comprime como siempre.
+    """
+    try:
+        with pikepdf.open(source) as pdf:
+            for page in pdf.pages:
+                node = page.obj
+                resources = node.get("/Resources")
+                while resources is None and "/Parent" in node:  # /Resources heredado del árbol
+                    node = node.Parent
+                    resources = node.get("/Resources")
+                if _draws_high_res_image(page.obj, resources, pikepdf.Matrix()):
+                    return True
+        return False
+    except Exception as e:
+        logging.warning(f"No se pudo analizar el PDF para compresión ({e}); se usa Ghostscript.")
+        return True
+
+
+# Cupos de procesos gs: compartidos por todas las carpetas, para no pasar de GS_WORKERS
+_gs_slots = threading.BoundedSemaphore(GS_WORKERS)
+
+
+def compress_pdf_gs(source: BinaryIO, output: BinaryIO, quality: str = "ebook") -> bool:
+    """
+    Comprime un PDF usando Ghostscript, pasándolo por tuberías (stdin -> gs -> stdout):
+    ni la entrada ni la salida necesitan existir como archivo.
     quality: screen | ebook | printer | prepress | default
-    Devuelve True si generó 'output_path'.
+    Devuelve True si escribió algo en 'output'.
     """
-    gs = shutil.which("gs") or "gs"  # binario Ghostscript
+    gs = _GS_BIN or "gs"  # binario Ghostscript (resuelto al arrancar)
     quality = (quality or "ebook").lower()
     settings_map = {
         "screen": "/screen",
@@ -245,42 +767,137 @@ def compress_pdf_gs(input_path: str, output_path: str, quality: str = "ebook") -
         "-dMonoImageDownsampleType=/Subsample",
         "-dMonoImageResolution=300",
         "-dNOPAUSE", "-dBATCH", "-dQUIET",
-        f"-sOutputFile={output_path}",
-        input_path,
+        "-sstdout=%stderr",  # mensajes de gs a stderr: stdout lleva solo el PDF
+        "-sOutputFile=-",
+        "-",
     ]
+
+    def _run_gs(src: BinaryIO, dst: BinaryIO) -> bool:
+        with _gs_slots:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            def _feed():
+                try:
+                    src.seek(0)
+                    shutil.copyfileobj(src, proc.stdin)
+                except BrokenPipeError:
+                    pass  # gs terminó antes: el error lo informa su código de salida
+                finally:
+                    proc.stdin.close()
+
+            # Se alimenta stdin desde otro hilo para no bloquearse leyendo stdout
+            feeder = threading.Thread(target=_feed, daemon=True)
+            feeder.start()
+            try:
+                dst.seek(0)
+                dst.truncate()
+                shutil.copyfileobj(proc.stdout, dst)
+            except BaseException:
+                # Falló la escritura de la salida (disco lleno, etc.): no dejar gs vivo ni
+                # el hilo de stdin bloqueado (al morir gs, su escritura falla y termina)
+                proc.kill()
+                raise
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+                feeder.join()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+            return _stream_size(dst) > 0
+
     try:
-        subprocess.run(cmd, check=True)
-        return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+        with pikepdf.open(source) as pdf:
+            n_pages = len(pdf.pages)
+        n_parts = min(GS_WORKERS, n_pages // GS_PAGES_PER_PART)
+        if n_parts < 2:
+            return _run_gs(source, output)
+        return _compress_in_parts(source, output, n_parts, _run_gs)
     except Exception as e:
         logging.warning(f"Compresión Ghostscript falló: {e}")
         return False
 
 
-# --------- Evitar duplicado del día ---------
-def trash_existing_compiled_for_today(drive, compiled_folder_id: str, date_str: str):
+def _compress_in_parts(source: BinaryIO, output: BinaryIO, n_parts: int, run_gs) -> bool:
     """
-    Si ya existe 'Compilado de YYYY-MM-DD.pdf' en la subcarpeta, lo manda a papelera.
-    Así evitamos duplicados si corres el flujo dos veces el mismo día.
+    Ghostscript usa un solo núcleo: parte el PDF en n_parts tramos de páginas, comprime
+    cada tramo en su propio proceso gs (en paralelo) y vuelve a unirlos en orden.
+    Recursos compartidos entre tramos (fuentes, etc.) quedan repetidos en cada uno;
+    el chequeo de tamaño de process_folder decide igual si vale la pena subirlo.
     """
+    with tempfile.TemporaryDirectory() as tmp, pikepdf.open(source) as src:
+        n_pages = len(src.pages)
+        bounds = [n_pages * k // n_parts for k in range(n_parts + 1)]
+        jobs = []
+        for k in range(n_parts):
+            part_in = os.path.join(tmp, f"in_{k:03d}.pdf")
+            with pikepdf.Pdf.new() as part:
+                part.pages.extend(src.pages[bounds[k]:bounds[k + 1]])
+                part.save(part_in)
+            jobs.append((part_in, os.path.join(tmp, f"out_{k:03d}.pdf")))
+
+        logging.info(f"Ghostscript en paralelo: {n_pages} páginas en {n_parts} tramos")
+        with ThreadPoolExecutor(max_workers=n_parts, thread_name_prefix="gs") as pool:
+            results = list(pool.map(lambda job: _run_gs_files(run_gs, *job), jobs))
+        if not all(results):
+            return False
+
+        parts = [pikepdf.open(part_out) for _, part_out in jobs]
+        try:
+            with pikepdf.Pdf.new() as out:
+                for part in parts:
+                    out.pages.extend(part.pages)
+                if len(out.pages) != n_pages:
+                    raise RuntimeError(f"Ghostscript devolvió {len(out.pages)} de {n_pages} páginas")
+                out.save(output)
+        finally:
+            for part in parts:
+                part.close()
+    return _stream_size(output) > 0
+
+
+def _run_gs_files(run_gs, src_path: str, dst_path: str) -> bool:
+    """Corre run_gs (que trabaja con archivos abiertos) sobre dos rutas."""
+    with open(src_path, "rb") as src, open(dst_path, "wb+") as dst:
+        return run_gs(src, dst)
+
+
+# --------- Evitar duplicado del día ---------
+def _compiled_for_day_request(drive, compiled_folder_id: str, date_str: str):
+    """Petición (sin ejecutar) que lista 'Compilado de YYYY-MM-DD.pdf' en la subcarpeta."""
     name = f"Compilado de {date_str}.pdf"
     q = f"'{compiled_folder_id}' in parents and name='{name}' and trashed=false"
-    resp = drive.files().list(
+    return drive.files().list(
         q=q, fields="files(id,name)", pageSize=10,
         includeItemsFromAllDrives=True, supportsAllDrives=True
-    ).execute()
-    for f in resp.get("files", []):
-        drive.files().update(fileId=f["id"], body={"trashed": True}, supportsAllDrives=True).execute()
-        logging.info(f"Duplicado previo enviado a papelera: {f['name']} ({f['id']})")
+    )
+
+
+def trash_existing_compiled_for_today(drive, compiled_folder_id: str, date_str: str,
+                                      existing: Optional[list] = None):
+    """
+    Si ya existe 'Compilado de YYYY-MM-DD.pdf' en la subcarpeta, lo manda a papelera.
+    Así evitamos duplicados si corres el flujo dos veces el mismo día.
+    'existing': resultado ya obtenido de esa búsqueda (p. ej. en list_folder_contents).
+    """
+    if existing is None:
+        existing = drive_execute(_compiled_for_day_request(drive, compiled_folder_id, date_str)).get("files", [])
+    files = existing
+    trashed = set(move_to_trash(drive, [f["id"] for f in files]))
+    for f in files:
+        if f["id"] in trashed:
+            logging.info(f"Duplicado previo enviado a papelera: {f['name']} ({f['id']})")
 
 
 # --------- Proceso de una carpeta ---------
 def process_folder(drive, folder_id: str) -> Optional[dict]:
     """Procesa una carpeta: mergea sus PDFs, comprime (si aplica) y manda originales a papelera."""
-    folder_name = get_folder_name(drive, folder_id)
+    # 1) Nombre + PDFs + subcarpeta 'Compilados' (si existe), en una sola ida y vuelta.
+    #    Con la subcarpeta en caché, en esa misma ida se buscan los compilados de hoy.
+    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
+    folder_name, pdfs, compiled_folder_id, compiled_today = list_folder_contents(
+        drive, folder_id, cached_compiled_folder(folder_id), date_str)
+    remember_compiled_folder(folder_id, compiled_folder_id)
     logging.info(f"== Carpeta fuente: {folder_name} ({folder_id}) ==")
-
-    # 1) Listar PDFs
-    pdfs = list_pdfs_in_folder(drive, folder_id)
     logging.info(f"PDFs encontrados: {len(pdfs)}")
 
     # 2) Si hay pocos PDFs, evitamos crear compilados vacíos o triviales
@@ -288,72 +905,99 @@ def process_folder(drive, folder_id: str) -> Optional[dict]:
         logging.info(f"Menos de {MIN_PDFS} PDFs. Se omite merge.")
         return None
 
-    # 3) Ordenar por fecha de creación (ascendente). Cambia a 'name' si te conviene.
-    pdfs.sort(key=lambda f: f.get("createdTime", ""))
+    # 3) Ya vienen ordenados por fecha de creación (ascendente): ver orderBy en
+    #    list_folder_contents (cámbialo a 'name' si te conviene).
+    #    Los PDFs idénticos (mismo md5) se descargan y unen una sola vez.
+    pdfs, duplicates = dedupe_by_checksum(pdfs)
+    if duplicates:
+        n_dup = sum(len(d) for d in duplicates.values())
+        logging.info(f"PDFs duplicados (mismo contenido) que no se repiten en el compilado: {n_dup}")
 
     # 4) Asegurar subcarpeta 'Compilados' dentro de ESTA carpeta
-    compiled_folder_id = ensure_compiled_subfolder(drive, folder_id)
-
-    with tempfile.TemporaryDirectory() as tmp:
-        local_paths = []
-        # 5) Descargar todos los PDFs a /tmp
-        for f in pdfs:
-            dest = os.path.join(tmp, f["name"])
-            download_file(drive, f["id"], dest)
-            local_paths.append(dest)
-
-        # 6) Hacer el merge local
-        date_str = datetime.datetime.now().strftime("%Y-%m-%d")
+    #    (el listado del paso 1 ya recorrió toda la carpeta: si no la vio, no existe)
+    compiled_folder_id = ensure_compiled_subfolder(drive, folder_id, compiled_folder_id, listed=True)
+    remember_compiled_folder(folder_id, compiled_folder_id)
+
+    with ExitStack() as stack:
+        # 5+6) Descargar a memoria (en paralelo) y hacer el merge a medida que llegan,
+        #      respetando el orden por fecha. El compilado queda en memoria salvo que
+        #      sea muy grande (SpooledTemporaryFile pasa a disco solo en ese caso).
+        def _spooled():
+            return stack.enter_context(tempfile.SpooledTemporaryFile(max_size=MERGE_SPOOL_MAX_SIZE))
+
         merged_name = f"Compilado de {date_str}.pdf"  # <-- nombre solicitado
-        merged_path = os.path.join(tmp, merged_name)
-        merge_local_pdfs(local_paths, merged_path)
+        merged = merge_local_pdfs((buf for _, buf in iter_downloads(pdfs)), _spooled())
 
         # 6.1) Evitar duplicado del mismo día
         if not DRY_RUN:
-            trash_existing_compiled_for_today(drive, compiled_folder_id, date_str)
-
-        # 7) (Opcional) Comprimir con Ghostscript antes de subir
-        final_upload_path = merged_path
-        if PDF_COMPRESS:
-            compressed_path = os.path.join(tmp, "__compressed__.pdf")
-            ok = compress_pdf_gs(merged_path, compressed_path, PDF_QUALITY)
+            trash_existing_compiled_for_today(drive, compiled_folder_id, date_str, compiled_today)
+
+        # 7) (Opcional) Comprimir (qpdf o Ghostscript) antes de subir
+        final_upload = merged
+        method = compression_method(merged) if PDF_COMPRESS else None
+        if PDF_COMPRESS and method is None:
+            logging.info("PDF sin imágenes de alta resolución; se omite Ghostscript.")
+        elif method:
+            compressed = _spooled()
+            if method == "gs":
+                ok = compress_pdf_gs(merged, compressed, PDF_QUALITY)
+            else:
+                ok = compress_pdf_qpdf(merged, compressed)
             if ok:
                 try:
-                    orig = os.path.getsize(merged_path)
-                    comp = os.path.getsize(compressed_path)
+                    orig = _stream_size(merged)
+                    comp = _stream_size(compressed)
                     if comp < orig * 0.98:  # al menos 2% más pequeño
-                        final_upload_path = compressed_path
-                        logging.info(f"Comprimido OK: {orig/1024:.1f}KB -> {comp/1024:.1f}KB ({PDF_QUALITY})")
+                        final_upload = compressed
+                        detail = PDF_QUALITY if method == "gs" else "sin pérdida"
+                        logging.info(f"Comprimido OK ({method}): {orig/1024:.1f}KB -> {comp/1024:.1f}KB ({detail})")
                     else:
                         logging.info("Compresión no redujo tamaño de forma útil; se sube original.")
                 except Exception:
                     pass
 
         # 8) Subir compilado a la subcarpeta 'Compilados'
-        uploaded = upload_pdf(drive, compiled_folder_id, final_upload_path, merged_name)
+        final_upload.seek(0)
+        uploaded = upload_pdf(drive, compiled_folder_id, final_upload, merged_name)
         logging.info(f"Compilado subido: {uploaded.get('webViewLink', 'dry_run')}")
 
-    # 9) Enviar originales a la PAPELERA (no borrar definitivo)
+    # 9) Enviar originales a la PAPELERA (no borrar definitivo).
+    #    Junto con sus duplicados (mismo md5), que no se descargaron.
+    to_trash = []
     for f in pdfs:
-        move_to_trash(drive, f["id"])
+        to_trash.append(f["id"])
+        to_trash.extend(d["id"] for d in duplicates.get(f["id"], []))
+    move_to_trash(drive, to_trash)
 
     return uploaded
 
 
 # --------- Entry point ---------
 def main():
-    drive = drive_client()
-    results = []
-    for fid in FOLDER_IDS:
-        try:
-            res = process_folder(drive, fid)
-            if res:
-                results.append(res)
-        except Exception as e:
-            # Importante: si una carpeta falla, seguimos con las demás.
-            logging.error(f"Error en carpeta {fid}: {e}")
-            continue
+    # Falla temprano si las credenciales no sirven (antes de repartir carpetas)
+    thread_drive_client()
+    load_compiled_cache()
 
+    def _run(fid: str) -> Optional[dict]:
+        # Cada hilo de carpeta usa su propio cliente Drive
+        return process_folder(thread_drive_client(), fid)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=FOLDER_CONCURRENCY, thread_name_prefix="carpeta") as pool:
+        # Un ID repetido en FOLDER_IDS se procesa una sola vez (dos hilos sobre la misma
+        # carpeta subirían dos compilados y mandarían a papelera los mismos originales)
+        futures = {pool.submit(_run, fid): fid for fid in dict.fromkeys(FOLDER_IDS)}
+        for fut in as_completed(futures):
+            fid = futures[fut]
+            try:
+                res = fut.result()
+                if res:
+                    results.append(res)
+            except Exception as e:
+                # Importante: si una carpeta falla, seguimos con las demás.
+                logging.error(f"Error en carpeta {fid}: {e}")
+
+    save_compiled_cache()
     logging.info(f"Terminado. Compilados generados: {len(results)}")
 
 